@@ -1,7 +1,8 @@
 # api.py
 from flask import Flask, request
+from sqlalchemy import insert, update
 from database import SessionLocal
-from models import User, Transaction
+from models import User, Transaction, TRANSACTION_KIND_ADJUSTMENT
 import os
 
 app = Flask(__name__)
@@ -15,18 +16,34 @@ def add_points():
     points = data.get('points')
     description = data.get('description', 'Points added')
 
-    user = db_session.query(User).filter_by(telegram_id=user_id).first()
-    if not user:
-        return {"status": "error", "message": "User not found"}, 404
+    # Validate before the value reaches SQL (bool is an int subclass, so exclude it explicitly)
+    if not isinstance(points, int) or isinstance(points, bool):
+        return {"status": "error", "message": "points must be an integer"}, 400
 
-    user.points += points
-    transaction = Transaction(
-        user_id=user_id,
-        points_change=points,
-        description=description
-    )
-    db_session.add(transaction)
-    db_session.commit()
+    # Core statements: atomic increment, no User object loaded or tracked
+    users_table = User.__table__
+    try:
+        user = db_session.execute(
+            update(users_table)
+            .where(users_table.c.telegram_id == user_id)
+            .values(points=users_table.c.points + points)
+            .returning(users_table.c.id)
+        ).first()
+        if not user:
+            db_session.rollback()
+            return {"status": "error", "message": "User not found"}, 404
+
+        db_session.execute(insert(Transaction.__table__).values(
+            user_id=user.id,
+            points_change=points,
+            description=description,
+            kind=TRANSACTION_KIND_ADJUSTMENT
+        ))
+        db_session.commit()
+    except Exception:
+        # Don't leave the shared session mid-transaction for the next request
+        db_session.rollback()
+        raise
     return {"status": "success", "message": f"{points} points added"}, 200
 
 if __name__ == '__main__':
@@ -1,18 +1,22 @@
 # bot.py
 
-import time
 import os
 import logging
-import qrcode
 import io
-import json
-import threading
+import re
+import orjson
 import queue
+import threading
+import time
+from collections import deque, defaultdict
 import uuid
-from datetime import datetime
-from pytz import timezone, utc
+import ssl
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
 from telegram import (
-    Update, InlineKeyboardMarkup, InlineKeyboardButton,
+    Update, Message, InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton, ParseMode, InputMediaPhoto
 )
 from telegram.ext import (
@@ -20,15 +24,20 @@ from telegram.ext import (
     MessageHandler, Filters, CallbackContext
 )
 from telegram.error import BadRequest
-from flask import Flask, request, abort
+from flask import Flask, request
 import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
+from cachetools import TTLCache
+from sqlalchemy import true, insert, update, case, func
+from sqlalchemy.orm import aliased
 from database import (
-    init_db, SessionLocal, User, Reward, Transaction,
-    Redemption, Event, UserSession, Configuration, TNGPin
+    init_db, SessionLocal, Session, User, Reward, Transaction,
+    Event, Configuration, TNGPin, CachedImage
 )
 
-from models import SensitiveInfoFilter
+from models import (
+    SensitiveInfoFilter, TRANSACTION_KIND_DISPOSAL, TRANSACTION_KIND_REDEMPTION
+)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -38,19 +47,70 @@ TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 BOT_USERNAME = os.getenv("BOT_USERNAME")  # e.g., "YourBotUsername"
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Your Render app's public URL, e.g., "https://your-app-name.onrender.com"
 PORT = int(os.getenv("PORT", 8443))  # Render sets the PORT environment variable automatically
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 32))  # Threads processing webhook updates (and run_async calls)
+MENU_CACHE_TTL = int(os.getenv("MENU_CACHE_TTL", 60))  # Seconds to reuse the events/rewards menus
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))  # Pending webhook updates before Telegram is told to retry
 
 MQTT_BROKER_URL = os.getenv("MQTT_BROKER_URL", "localhost")
 MQTT_BROKER_PORT = int(os.getenv("MQTT_BROKER_PORT", 8883))
 MQTT_USERNAME = os.getenv("MQTT_USERNAME")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
-MQTT_TOPIC = os.getenv("MQTT_TOPIC", "rubbish/disposal")
+MQTT_TOPIC = os.getenv("MQTT_TOPIC", "rubbish/disposal")  # Comma-separated, e.g. "rubbish/disposal/+,rubbish/status"
+MQTT_TOPICS = [topic.strip() for topic in MQTT_TOPIC.split(",") if topic.strip()]
+MQTT_USE_TLS = os.getenv("MQTT_USE_TLS", "True").lower() == "true"
+MQTT_TLS_INSECURE = os.getenv("MQTT_TLS_INSECURE", "False").lower() == "true"
+MQTT_TLS_CA_CERT = os.getenv("MQTT_TLS_CA_CERT")
+MQTT_TLS_CERTFILE = os.getenv("MQTT_TLS_CERTFILE")
+MQTT_TLS_KEYFILE = os.getenv("MQTT_TLS_KEYFILE")
+MQTT_BATCH_SIZE = int(os.getenv("MQTT_BATCH_SIZE", 128))  # Disposals written per DB round-trip
+MQTT_FLUSH_INTERVAL = float(os.getenv("MQTT_FLUSH_INTERVAL", 0.2))  # Seconds; 0 writes each disposal immediately
+MQTT_INBOX_SIZE = int(os.getenv("MQTT_INBOX_SIZE", 50000))  # Unprocessed messages kept; oldest dropped beyond this
+ACTIVE_USER_CACHE_TTL = int(os.getenv("ACTIVE_USER_CACHE_TTL", 30))  # Seconds to reuse the bin's active user
+NOTIFICATION_WORKERS = int(os.getenv("NOTIFICATION_WORKERS", 8))  # Threads sending disposal notifications
+NOTIFICATION_BATCH_SIZE = int(os.getenv("NOTIFICATION_BATCH_SIZE", 64))  # Notifications collected per coalescing round
+NOTIFICATION_BATCH_WINDOW = float(os.getenv("NOTIFICATION_BATCH_WINDOW", 0.1))  # Seconds to wait for more notifications
+TELEGRAM_RATE_LIMIT = int(os.getenv("TELEGRAM_RATE_LIMIT", 30))  # Notification sends per second (Telegram's bot-wide limit)
+NOTIFICATION_QUEUE_SIZE = int(os.getenv("NOTIFICATION_QUEUE_SIZE", 10000))  # Oldest notifications dropped beyond this
 ADMIN_TELEGRAM_ID = os.getenv("ADMIN_TELEGRAM_ID")  # For error notifications
+IMAGE_CACHE_CHAT_ID = os.getenv("IMAGE_CACHE_CHAT_ID")  # Chat/channel the static images are uploaded to at startup
 
 # Ensure critical environment variables are defined
 if not TOKEN:
     raise ValueError("Environment variable TELEGRAM_BOT_TOKEN is not set.")
 if not WEBHOOK_URL:
     raise ValueError("Environment variable WEBHOOK_URL is not set.")
+if bool(MQTT_USERNAME) != bool(MQTT_PASSWORD):
+    raise ValueError("Environment variables MQTT_USERNAME and MQTT_PASSWORD must be set together.")
+
+# Local time (Asia/Kuala_Lumpur) used when displaying timestamps. Malaysia has been
+# UTC+8 with no DST since 1982, so stored naive-UTC times can be shifted directly
+LOCAL_UTC_OFFSET = timedelta(hours=8)
+HISTORY_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Points awarded per rubbish type reported by the bin
+RUBBISH_POINTS = MappingProxyType({
+    "plastic": 10,
+    "metal": 25,
+    "paper": 5,
+    "glass": 15,
+})
+
+# One-byte rubbish type codes sent by the bin firmware (JSON payloads are still accepted)
+RUBBISH_BY_CODE = {
+    0x01: "plastic",
+    0x02: "metal",
+    0x03: "paper",
+    0x04: "glass",
+}
+
+# Only the update types the handlers consume are pushed to the webhook
+WEBHOOK_ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Every callback_data the bot emits: a fixed action, or "redeem_<id>" / "event_<id>"
+CB_ROUTE = re.compile(
+    r"^(?:(?P<action>check_balance|redeem_rewards|view_events|leaderboard|main_menu|view_disposal_history)"
+    r"|(?P<prefix>redeem|event)_(?P<id>\d+))$"
+)
 
 # Image URLs
 COMPANY_IMAGE_URL = "https://img.freepik.com/premium-photo/earth-day-poster-background-illustration-vertical-concept-design-poster-greeting-card-flat-lay_108611-3386.jpg"  # Main menu image
@@ -59,6 +119,35 @@ VIEW_EVENTS_IMAGE_URL = "https://i.pinimg.com/originals/c3/b7/30/c3b73071bac1d68
 REDEEM_REWARDS_IMAGE_URL = "https://static.vecteezy.com/system/resources/previews/000/299/799/original/earth-day-vector-design-for-card-poster-banner-flyer.jpg"
 LEADERBOARD_IMAGE_URL = "https://th.bing.com/th/id/OIP.AytYm-aNAOHKnfBk_4UxiwHaHa?rs=1&pid=ImgDetMain"
 VIEW_DISPOSAL_HISTORY_IMAGE_URL = "https://i.pinimg.com/originals/ae/b3/20/aeb32056367d7927dc69888bc4398d68.jpg"
+STATIC_IMAGE_URLS = frozenset({
+    COMPANY_IMAGE_URL,
+    CHECK_BALANCE_IMAGE_URL,
+    VIEW_EVENTS_IMAGE_URL,
+    REDEEM_REWARDS_IMAGE_URL,
+    LEADERBOARD_IMAGE_URL,
+    VIEW_DISPOSAL_HISTORY_IMAGE_URL,
+})
+
+# Telegram file_ids of the static images, captured after their first upload
+IMAGE_FILE_IDS = {}
+
+# Disposal notification, rendered by the sender thread from the queued tuple
+DISPOSAL_NOTIFICATION_TEMPLATE = (
+    "🎉 *Great Job*, %s!\n\n"
+    "You've earned *%d points* for disposing *%s*.\n\n"
+    "💰 *Your current balance:* %d points."
+)
+# Joins several notifications for the same chat into one message
+NOTIFICATION_SEPARATOR = "\n\n───\n\n"
+
+# Main menu inline keyboard (static, so built once at import)
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💰 Check Balance", callback_data="check_balance")],
+    [InlineKeyboardButton("🎁 Redeem Rewards", callback_data="redeem_rewards")],
+    [InlineKeyboardButton("📅 View Events", callback_data="view_events")],
+    [InlineKeyboardButton("🏆 Leaderboard", callback_data="leaderboard")],
+    [InlineKeyboardButton("🗑️ View Disposal History", callback_data="view_disposal_history")],  # New button
+])
 
 # Configure logging
 logging.basicConfig(
@@ -67,72 +156,238 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)  # Define logger here
 
+# paho logs every packet at DEBUG; only surface its warnings and errors
+logging.getLogger("paho").setLevel(logging.WARNING)
+
 # Apply sensitive info filter
-sensitive_filter = SensitiveInfoFilter([TOKEN, os.getenv("DATABASE_URL"), os.getenv("API_KEY")])
+sensitive_filter = SensitiveInfoFilter((TOKEN, os.getenv("DATABASE_URL"), os.getenv("API_KEY")))
 
 # Add the filter to all handlers
 for handler in logging.getLogger().handlers:
     handler.addFilter(sensitive_filter)
 
-# Enable logging for MQTT
-mqtt.Client().enable_logger(logger)
-
 # Create a Flask app
 app = Flask(__name__)
 
+# Prebuilt events/rewards menus; edits made by the admin scripts show up once the TTL expires
+menu_cache = TTLCache(maxsize=8, ttl=MENU_CACHE_TTL)
+menu_cache_lock = threading.Lock()
+
+class NotificationQueue:
+    """Single-producer/single-consumer queue: a deque plus an Event to wake the consumer.
+
+    deque.append/popleft are atomic in CPython, so the MQTT flusher and the sender
+    thread never contend on a lock the way they would with queue.Queue. The deque is
+    bounded: while Telegram is unreachable the oldest notifications are dropped.
+    """
+
+    def __init__(self, maxsize):
+        self._items = deque(maxlen=maxsize)
+        self._ready = threading.Event()
+        self._dropped = 0
+        self._last_drop_warning = 0.0
+
+    def put(self, item):
+        if len(self._items) == self._items.maxlen:
+            self._dropped += 1
+            now = time.monotonic()
+            if now - self._last_drop_warning >= 60:
+                logger.warning(f"⚠️ Notification queue full; dropped {self._dropped} oldest notifications so far.")
+                self._last_drop_warning = now
+        self._items.append(item)
+        self._ready.set()
+
+    def get(self):
+        """Return the next item, blocking only while the queue is empty."""
+        while True:
+            try:
+                return self._items.popleft()
+            except IndexError:
+                self._ready.wait()
+                self._ready.clear()
+
+    def get_batch(self, max_items, window):
+        """Block for the first item, then keep collecting for up to window seconds or max_items items."""
+        batch = [self.get()]
+        deadline = time.monotonic() + window
+        while len(batch) < max_items:
+            try:
+                batch.append(self._items.popleft())
+            except IndexError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._ready.wait(remaining)
+                self._ready.clear()
+        return batch
+
+class RateLimiter:
+    """Token bucket shared by the sender threads: at most rate calls per second, bursts up to rate."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until one is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
 # Initialize the message queue
-message_queue = queue.Queue()
+message_queue = NotificationQueue(maxsize=NOTIFICATION_QUEUE_SIZE)
+notification_rate_limiter = RateLimiter(TELEGRAM_RATE_LIMIT)
+
+# Set by initialize_bot(); handlers use it to invalidate the cached active user
+mqtt_client = None
 
 # Initialize the Updater and Dispatcher globally
-updater = Updater(TOKEN, use_context=True)
+# One keep-alive connection pool shared by the update workers, the run_async pool and the notification senders
+updater = Updater(
+    TOKEN,
+    workers=BOT_WORKERS,
+    use_context=True,
+    request_kwargs={
+        "con_pool_size": 2 * BOT_WORKERS + NOTIFICATION_WORKERS + 4,
+        "connect_timeout": 20,
+        "read_timeout": 20,
+    },
+)
 dispatcher = updater.dispatcher
 
+# Webhook updates waiting for a worker; the handlers run synchronously on those workers,
+# so this queue is the whole backlog and its maxsize is a real bound
+webhook_updates = queue.Queue(maxsize=UPDATE_QUEUE_SIZE)
+
 @app.route("/")
 def home():
     return "Bot is running!"
 
 @app.route(f"/{TOKEN}", methods=['POST'])
 def webhook_handler():
-    if request.method == "POST":
-        update = Update.de_json(request.get_json(force=True), updater.bot)
-        dispatcher.process_update(update)
-        return "OK", 200
-    else:
-        abort(403)
+    update = Update.de_json(request.get_json(force=True), updater.bot)
+    # Hand the update to the worker threads and acknowledge Telegram right away
+    try:
+        webhook_updates.put_nowait(update)
+    except queue.Full:
+        # Past the backlog limit, refuse the update so Telegram redelivers it later instead of losing it
+        logger.warning("⚠️ Update queue is full (%d pending); asking Telegram to retry.", UPDATE_QUEUE_SIZE)
+        return "Busy", 503
+    return "OK", 200
+
+def process_updates():
+    """Worker loop: run queued webhook updates through the dispatcher's handlers."""
+    while True:
+        update = webhook_updates.get()
+        try:
+            dispatcher.process_update(update)
+        except Exception as e:
+            logger.error(f"❌ Error processing update: {e}")
 
 # Utility Functions
 def generate_logger(name):
-    logger = logging.getLogger(name)
-    if not logger.handlers:
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        logger.setLevel(logging.INFO)
-    return logger
+    """Return a named logger; records propagate to the root handler set up by basicConfig."""
+    return logging.getLogger(name)
+
+def with_session(handler):
+    """Run a handler with a thread-local database session and release it afterwards."""
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext):
+        db = Session()
+        try:
+            return handler(update, context, db)
+        finally:
+            Session.remove()
+    return wrapper
+
+def cached_menu(key, build):
+    """Return the cached menu for key, rebuilding it with build() when missing or expired."""
+    with menu_cache_lock:
+        if key in menu_cache:
+            return menu_cache[key]
+    menu = build()
+    with menu_cache_lock:
+        menu_cache[key] = menu
+    return menu
 
 def main_menu():
     """Main menu inline keyboard."""
-    keyboard = [
-        [InlineKeyboardButton("💰 Check Balance", callback_data="check_balance")],
-        [InlineKeyboardButton("🎁 Redeem Rewards", callback_data="redeem_rewards")],
-        [InlineKeyboardButton("📅 View Events", callback_data="view_events")],
-        [InlineKeyboardButton("🏆 Leaderboard", callback_data="leaderboard")],
-        [InlineKeyboardButton("🗑️ View Disposal History", callback_data="view_disposal_history")],  # New button
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return MAIN_MENU_MARKUP
+
+def remember_file_id(media_url, message):
+    """Cache the file_id Telegram assigned to a static image so it is not fetched again."""
+    if media_url in STATIC_IMAGE_URLS and media_url not in IMAGE_FILE_IDS:
+        if isinstance(message, Message) and message.photo:
+            IMAGE_FILE_IDS[media_url] = message.photo[-1].file_id
+            persist_file_id(media_url, IMAGE_FILE_IDS[media_url])
+
+def persist_file_id(media_url, file_id):
+    """Store a static image's file_id so later restarts skip the upload."""
+    # Own session: this runs inside handlers that are mid-way through their own unit of work
+    db = SessionLocal()
+    try:
+        db.merge(CachedImage(url=media_url, file_id=file_id))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Unable to store file_id for {media_url}: {e}")
+    finally:
+        db.close()
+
+def load_image_file_ids():
+    """Load the file_ids stored by earlier runs into IMAGE_FILE_IDS."""
+    db = SessionLocal()
+    try:
+        rows = db.query(CachedImage.url, CachedImage.file_id).filter(CachedImage.url.in_(STATIC_IMAGE_URLS)).all()
+        IMAGE_FILE_IDS.update({row.url: row.file_id for row in rows})
+    except Exception as e:
+        logger.warning(f"Unable to load stored image file_ids: {e}")
+    finally:
+        db.close()
+
+def preload_images(bot):
+    """Upload the static images once to IMAGE_CACHE_CHAT_ID so even the first view uses a file_id."""
+    if not IMAGE_CACHE_CHAT_ID:
+        logger.info("IMAGE_CACHE_CHAT_ID not set; static images will be cached on first use.")
+        return
+
+    def upload(media_url):
+        try:
+            message = bot.send_photo(chat_id=IMAGE_CACHE_CHAT_ID, photo=media_url, disable_notification=True)
+            remember_file_id(media_url, message)
+        except Exception as e:
+            logger.warning(f"Unable to preload image {media_url}: {e}")
+
+    # Each upload waits on Telegram fetching the image, so run them side by side
+    missing = STATIC_IMAGE_URLS - IMAGE_FILE_IDS.keys()
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing), thread_name_prefix="preload") as executor:
+            executor.map(upload, missing)
+    logger.info(f"🖼️ Cached file_ids for {len(IMAGE_FILE_IDS)} static images.")
 
 def safe_edit_message_media(query, media_url, caption, reply_markup=None):
     """Safely edit the message media (photo) and caption."""
     try:
-        # Add cache busting to the media URL
-        cache_busted_url = f"{media_url}?v={int(time.time())}"
-
-        media = InputMediaPhoto(media=cache_busted_url, caption=caption, parse_mode=ParseMode.MARKDOWN)
-        query.edit_message_media(
+        # Reuse the uploaded file_id when known so Telegram skips the external fetch
+        media = InputMediaPhoto(
+            media=IMAGE_FILE_IDS.get(media_url, media_url),
+            caption=caption,
+            parse_mode=ParseMode.MARKDOWN
+        )
+        message = query.edit_message_media(
             media=media,
             reply_markup=reply_markup if reply_markup else main_menu()
         )
+        remember_file_id(media_url, message)
     except BadRequest as e:
         if "Message is not modified" in str(e):
             pass
@@ -143,32 +398,39 @@ def safe_edit_message_media(query, media_url, caption, reply_markup=None):
         logger.error(f"Unexpected error in safe_edit_message_media: {e}")
         raise e
 
+def delete_event_poster_message(bot, chat_id: int, message_id: int):
+    """Delete an event poster message, logging instead of raising on failure."""
+    try:
+        bot.delete_message(chat_id=chat_id, message_id=message_id)
+        logger.info(f"Deleted event poster message ID: {message_id}")
+    except BadRequest as e:
+        logger.error(f"BadRequest error deleting event poster message: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error deleting event poster message: {e}")
+
 def delete_current_event_poster(context: CallbackContext, chat_id: int):
-    """Delete the current event poster if it exists."""
-    current_photo_message = context.user_data.get('current_event_photo')
+    """Delete the current event poster if it exists, without waiting on the API call."""
+    current_photo_message = context.user_data.pop('current_event_photo', None)
     if current_photo_message:
-        try:
-            context.bot.delete_message(
-                chat_id=chat_id,
-                message_id=current_photo_message
-            )
-            logger.info(f"Deleted event poster message ID: {current_photo_message}")
-        except BadRequest as e:
-            logger.error(f"BadRequest error deleting event poster message: {e}")
-        except Exception as e:
-            logger.error(f"Unexpected error deleting event poster message: {e}")
-        finally:
-            context.user_data.pop('current_event_photo', None)
+        context.dispatcher.run_async(delete_event_poster_message, context.bot, chat_id, current_photo_message)
 
-def send_main_menu(chat_id, context, text="What would you like to do?"):
-    cache_busted_url = f"{COMPANY_IMAGE_URL}?v={int(time.time())}"  # Add a unique query string to prevent caching
+def answer_callback_query(query, context: CallbackContext):
+    """Acknowledge a button press on the worker pool instead of waiting on the round-trip."""
+    context.dispatcher.run_async(query.answer)
 
-    context.bot.send_photo(
+def send_main_menu(chat_id, context, text="What would you like to do?"):
+    message = context.bot.send_photo(
         chat_id=chat_id,
-        photo=cache_busted_url,
+        photo=IMAGE_FILE_IDS.get(COMPANY_IMAGE_URL, COMPANY_IMAGE_URL),
         caption=text,
         reply_markup=main_menu()
     )
+    remember_file_id(COMPANY_IMAGE_URL, message)
+
+def invalidate_active_user():
+    """Make the MQTT handler pick up a newly activated user on its next disposal."""
+    if mqtt_client:
+        mqtt_client.invalidate_active_user()
 
 def send_notification_message(bot, chat_id: int, text: str):
     """Send a notification message to the user."""
@@ -192,59 +454,62 @@ def request_registration(update: Update, context: CallbackContext):
         reply_markup=reply_markup,
     )
 
-def start(update: Update, context: CallbackContext): 
+# The user currently set as active in the configuration table
+PreviousUser = aliased(User)
+
+@with_session
+def start(update: Update, context: CallbackContext, db):
     """Handle the /start command with optional activation parameter."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     args = context.args  # Arguments passed with /start (e.g., activate_bin)
 
-    logger.info(f"Received /start command from user: {user_id}")
-
-    # Initialize the database session
-    db = SessionLocal()
+    logger.info("Received /start command from user: %s", user_id)
 
     try:
-        # Check if the user is already registered
-        user = db.query(User).filter_by(telegram_id=user_id).first()
-        config = db.query(Configuration).first()
+        # Fetch the user, the configuration and the currently active user in one round-trip
+        row = (
+            db.query(User, Configuration, PreviousUser)
+            .outerjoin(Configuration, true())
+            .outerjoin(PreviousUser, PreviousUser.id == Configuration.active_user_id)
+            .filter(User.telegram_id == user_id)
+            .first()
+        )
+        user, config, previous_user = row if row else (None, None, None)
 
         if user:
             # If the user exists, handle the optional "activate_bin" parameter
             if args and args[0] == "activate_bin":
-                # Check if there's an active user in the configuration table
-                previous_user = None
-                if config and config.active_user_id:
-                    previous_user = db.query(User).filter_by(id=config.active_user_id).first()
-
                 # Deactivate the previous active user (if any)
                 if previous_user and previous_user.id != user.id:
-                    logger.info(f"Deactivating previous user: {previous_user.name} (ID: {previous_user.telegram_id}).")
+                    logger.info("Deactivating previous user: %s (ID: %s).", previous_user.name, previous_user.telegram_id)
                     try:
                         context.bot.send_message(
                             chat_id=previous_user.telegram_id,
                             text="🔔 You have been deactivated as the active user for the bin."
                         )
-                        logger.info(f"Notified previous active user: {previous_user.name} (ID: {previous_user.telegram_id}).")
+                        logger.info("Notified previous active user: %s (ID: %s).", previous_user.name, previous_user.telegram_id)
                     except Exception as e:
-                        logger.warning(f"Unable to notify previous user: {e}")
+                        logger.warning("Unable to notify previous user: %s", e)
 
                 # Assign the current user as the active user
                 if not config:
                     config = Configuration(active_user_id=user.id)
                     db.add(config)
-                    logger.info(f"Created new Configuration with active_user_id: {user.id}")
+                    logger.info("Created new Configuration with active_user_id: %s", user.id)
                 else:
                     config.active_user_id = user.id
-                    logger.info(f"Set active_user_id to: {user.id}")
+                    logger.info("Set active_user_id to: %s", user.id)
 
                 db.commit()
+                invalidate_active_user()
 
                 # Notify the user
                 update.message.reply_text(
                     f"🎉 Welcome, {user.name}! You are now the active user for the bin.\n"
                     f"Start disposing to earn points."
                 )
-                logger.info(f"User {user.name} (ID: {user.telegram_id}) is now active.")
+                logger.info("User %s (ID: %s) is now active.", user.name, user.telegram_id)
             else:
                 # Regular /start command without activation
                 send_main_menu(chat_id, context, text=f"Hello {user.name}! Welcome back.")
@@ -256,39 +521,40 @@ def start(update: Update, context: CallbackContext):
             # Note: Removed active user assignment logic from here
 
     except Exception as e:
-        logger.error(f"❌ Error processing /start command for user {user_id}: {e}")
+        logger.error("❌ Error processing /start command for user %s: %s", user_id, e)
         update.message.reply_text("🚫 An error occurred while processing your request. Please try again later.")
-    finally:
-        db.close()
-        logger.info(f"Database session closed for user {user_id}.")
 
-def active_user(update: Update, context: CallbackContext):
-    db = SessionLocal()
-    config = db.query(Configuration).first()
-    if config and config.active_user_id:
-        active_user = db.query(User).filter_by(id=config.active_user_id).first()
-        if active_user:
-            update.message.reply_text(
-                f"👤 *Active User:* {active_user.name}\n"
-                f"📱 *Telegram ID:* {active_user.telegram_id}",
-                parse_mode=ParseMode.MARKDOWN
-            )
-        else:
-            update.message.reply_text("⚠️ No active user found.")
+def current_active_user_id(db):
+    """The bin's active user id, served from the MQTT handler's cache when it is running."""
+    if mqtt_client:
+        return mqtt_client.get_active_user_id()
+    row = db.query(Configuration.active_user_id).first()
+    return row.active_user_id if row else None
+
+@with_session
+def active_user(update: Update, context: CallbackContext, db):
+    active_user_id = current_active_user_id(db)
+    active_user = None
+    if active_user_id:
+        active_user = db.query(User.name, User.telegram_id).filter_by(id=active_user_id).first()
+    if active_user:
+        update.message.reply_text(
+            f"👤 *Active User:* {active_user.name}\n"
+            f"📱 *Telegram ID:* {active_user.telegram_id}",
+            parse_mode=ParseMode.MARKDOWN
+        )
     else:
         update.message.reply_text("⚠️ No active user found.")
-    db.close()
 
-def register_contact(update: Update, context: CallbackContext):
+@with_session
+def register_contact(update: Update, context: CallbackContext, db):
     """Handle contact sharing and register the user."""
     contact = update.message.contact
     user_id = update.effective_user.id
 
-    db = SessionLocal()
-    user = db.query(User).filter_by(telegram_id=user_id).first()
-    if user:
+    # Only need to know whether the row exists, not load it
+    if db.query(db.query(User).filter_by(telegram_id=user_id).exists()).scalar():
         update.message.reply_text("✅ You are already registered.")
-        db.close()
         return
 
     # Create a new user entry
@@ -307,26 +573,24 @@ def register_contact(update: Update, context: CallbackContext):
     update.message.reply_text(
         "📝 Thank you! Please enter your name to complete registration."
     )
-    logger.info(f"User {user_id} shared contact and is awaiting name input.")
-    db.close()
+    logger.info("User %s shared contact and is awaiting name input.", user_id)
 
-def collect_name(update: Update, context: CallbackContext):
+@with_session
+def collect_name(update: Update, context: CallbackContext, db):
     """Handle name input and complete registration."""
     user_id = update.effective_user.id
-    db = SessionLocal()
     user = db.query(User).filter_by(telegram_id=user_id).first()
 
     # Validate the registration step
     if not user or 'registration_step' not in context.user_data or context.user_data['registration_step'] != 'awaiting_name':
-        logger.warning(f"User {user_id} sent unexpected input during registration.")
+        logger.warning("User %s sent unexpected input during registration.", user_id)
         update.message.reply_text("❌ Unexpected input. Use /start to register.")
-        db.close()
         return
 
     # Store the name
     user.name = update.message.text.strip()
     db.commit()
-    logger.info(f"User {user_id} has registered with name: {user.name}")
+    logger.info("User %s has registered with name: %s", user_id, user.name)
 
     # Fetch the Configuration
     config = db.query(Configuration).first()
@@ -340,41 +604,41 @@ def collect_name(update: Update, context: CallbackContext):
                     chat_id=previous_user.telegram_id,
                     text="🔔 You have been deactivated as the active user for the bin."
                 )
-                logger.info(f"Notified previous active user: {previous_user.name} (ID: {previous_user.telegram_id}).")
+                logger.info("Notified previous active user: %s (ID: %s).", previous_user.name, previous_user.telegram_id)
             except Exception as e:
-                logger.warning(f"Unable to notify previous user: {e}")
+                logger.warning("Unable to notify previous user: %s", e)
 
     # Set the new user as the active user
     if not config:
         config = Configuration(active_user_id=user.id)
         db.add(config)
-        logger.info(f"Created new Configuration with active_user_id: {user.id}")
+        logger.info("Created new Configuration with active_user_id: %s", user.id)
     else:
         config.active_user_id = user.id
-        logger.info(f"Set active_user_id to: {user.id}")
+        logger.info("Set active_user_id to: %s", user.id)
 
     db.commit()
+    invalidate_active_user()
 
     # Notify the new active user
     update.message.reply_text(
         f"🎉 You have been registered and are now the active user for the bin, {user.name}!\n"
         f"Start disposing to earn points."
     )
-    logger.info(f"User {user.name} (ID: {user.telegram_id}) is now active.")
+    logger.info("User %s (ID: %s) is now active.", user.name, user.telegram_id)
 
     # Clear the registration step
     context.user_data.pop('registration_step', None)
-    db.close()
 
-def check_balance_callback(update: Update, context: CallbackContext):
+@with_session
+def check_balance_callback(update: Update, context: CallbackContext, db):
     """Display the user's current balance and update the image."""
     query = update.callback_query
+    answer_callback_query(query, context)
     user_id = query.from_user.id
-    db = SessionLocal()
-    user = db.query(User).filter_by(telegram_id=user_id).first()
+    user = db.query(User.name, User.points).filter_by(telegram_id=user_id).first()
 
     if user:
-        query.answer()
         message_text = (
             f"👤 *{user.name}*, your current balance is: *{user.points} points*.\n\nWhat would you like to do next?"
         )
@@ -390,54 +654,62 @@ def check_balance_callback(update: Update, context: CallbackContext):
             reply_markup=main_menu(),
         )
     else:
-        query.answer()
         safe_edit_message_media(
             query,
             COMPANY_IMAGE_URL,  # Use an appropriate image URL
             "❌ You are not registered. Please use /start to register.",
             reply_markup=main_menu()
         )
-    db.close()
 
-def redeem_rewards_callback(update: Update, context: CallbackContext):
+def build_rewards_menu(db):
+    """Build the rewards listing and keyboard, or None when there are no rewards."""
+    rewards = db.query(Reward.id, Reward.name, Reward.points_required).all()
+    if not rewards:
+        return None
+    lines = ["🎁 *Available Rewards:*", ""]
+    keyboard = []
+    for reward in rewards:
+        lines.append(f"{reward.id}. {reward.name} - {reward.points_required} points")
+        keyboard.append([InlineKeyboardButton(f"{reward.name}", callback_data=f"redeem_{reward.id}")])
+    keyboard.append([InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")])
+    lines.append("")
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+@with_session
+def redeem_rewards_callback(update: Update, context: CallbackContext, db):
     """Display the rewards menu with appropriate image."""
     query = update.callback_query
-    db = SessionLocal()
+    answer_callback_query(query, context)
 
     # Delete the current event poster if it exists
     delete_current_event_poster(context, query.message.chat_id)
 
     # Fetch available rewards
-    rewards = db.query(Reward).all()
-    if rewards:
-        message = "🎁 *Available Rewards:*\n\n"
-        keyboard = []
-        for reward in rewards:
-            message += f"{reward.id}. {reward.name} - {reward.points_required} points\n"
-            keyboard.append([InlineKeyboardButton(f"{reward.name}", callback_data=f"redeem_{reward.id}")])
-        keyboard.append([InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")])
-        query.answer()
-        
+    rewards_menu = cached_menu("rewards", lambda: build_rewards_menu(db))
+    if rewards_menu:
+        message, reply_markup = rewards_menu
+
         # Update the message media with the Redeem Rewards image
         safe_edit_message_media(
             query,
             REDEEM_REWARDS_IMAGE_URL,  # Correct image URL
             f"{message}\nSelect a reward to redeem:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=reply_markup
         )
     else:
-        query.answer()
         safe_edit_message_media(
             query,
             REDEEM_REWARDS_IMAGE_URL,  # Use appropriate image
             "🛍️ No rewards available at the moment.\n\nWhat would you like to do next?",
             reply_markup=main_menu(),
         )
-    db.close()
 
-def get_tng_pin(session: SessionLocal, reward: Reward, user: User) -> str:
+def get_tng_pin(session: Session, reward: Reward, user: User) -> str:
     """
     Retrieves an unused TNG pin for a reward and marks it as used.
+
+    The change is only staged on the session; the caller commits it together
+    with the rest of the redemption.
     
     Args:
         session (Session): The active database session.
@@ -447,194 +719,175 @@ def get_tng_pin(session: SessionLocal, reward: Reward, user: User) -> str:
     Returns:
         str: The TNG pin if available, or raises an exception if not.
     """
-    try:
-        # Query the first available unused TNG pin for the specified reward
-        tng_pin = session.query(TNGPin).filter(
-            TNGPin.reward_id == reward.id,
-            TNGPin.used == False
-        ).first()
-
-        if not tng_pin:
-            raise ValueError(f"No unused TNG pins available for reward: {reward.name}")
-
-        # Mark the pin as used
-        tng_pin.used = True
-        tng_pin.used_by = user.telegram_id
-        tng_pin.used_at = datetime.utcnow()
-        logger.info(f"TNG PIN {tng_pin.pin} redeemed by user {user.name} (ID: {user.telegram_id}) at {tng_pin.used_at}")
-        
-        # Commit the changes to the database
-        session.commit()
-
-        return tng_pin.pin
-    except Exception as e:
-        session.rollback()  # Rollback in case of an error
-        raise e
-        
-def process_reward_selection(update: Update, context: CallbackContext):
+    # Claim the first available unused TNG pin for the specified reward;
+    # SKIP LOCKED hands concurrent redemptions different rows instead of the same one
+    tng_pin = session.query(TNGPin).filter(
+        TNGPin.reward_id == reward.id,
+        TNGPin.used == False
+    ).with_for_update(skip_locked=True).first()
+
+    if not tng_pin:
+        raise ValueError(f"No unused TNG pins available for reward: {reward.name}")
+
+    # Mark the pin as used
+    tng_pin.used = True
+    tng_pin.used_by = user.id
+    tng_pin.used_at = datetime.utcnow()
+    logger.info("TNG PIN %s redeemed by user %s (ID: %s) at %s", tng_pin.pin, user.name, user.telegram_id, tng_pin.used_at)
+
+    return tng_pin.pin
+
+@with_session
+def process_reward_selection(update: Update, context: CallbackContext, db):
     """Process the reward selection and handle redemption."""
     query = update.callback_query
+    answer_callback_query(query, context)
     user_id = query.from_user.id
-    db = SessionLocal()
 
-    # Get the reward_id from the callback_data
-    data = query.data
-    if data.startswith('redeem_'):
-        try:
-            reward_id = int(data.split('_')[1])
-        except (IndexError, ValueError):
-            query.answer()
-            safe_edit_message_media(
-                query,
-                COMPANY_IMAGE_URL,  # Use a fallback image URL here
-                "❌ Invalid reward selection. Please try again.",
-                reply_markup=main_menu()
-            )
-            db.close()
-            return
-    else:
-        query.answer()
-        db.close()
-        return
+    # The handler pattern only matches redeem_<digits>, so the ID is always present
+    reward_id = int(context.match.group("id"))
 
+    # Plain reads for the early checks; stock and points are enforced atomically below
     user = db.query(User).filter_by(telegram_id=user_id).first()
 
     # Check if user is registered
     if not user:
-        query.answer()
         safe_edit_message_media(
             query,
             COMPANY_IMAGE_URL,  # Use a fallback image URL here
             "❌ You are not registered. Please use /start to register.",
             reply_markup=main_menu()
         )
-        logger.info(f"{user_id} - Failed redemption: User not registered.")
-        db.close()
+        logger.info("%s - Failed redemption: User not registered.", user_id)
         return
 
     reward = db.query(Reward).filter_by(id=reward_id).first()
 
     if not reward:
-        query.answer()
         safe_edit_message_media(
             query,
             COMPANY_IMAGE_URL,  # Use a fallback image URL here
             "❌ Invalid reward selection.",
             reply_markup=main_menu()
         )
-        logger.info(f"{user.name} (ID: {user.telegram_id}) - Failed redemption: Invalid reward ID ({reward_id}).")
-        db.close()
-        return
-    if user.points < reward.points_required:
-        query.answer()
-        safe_edit_message_media(
-            query,
-            COMPANY_IMAGE_URL,  # Use a fallback image URL here
-            "❌ You don't have enough points to redeem this reward.",
-            reply_markup=main_menu()
-        )
-        logger.info(f"{user.name} (ID: {user.telegram_id}) - Failed redemption: Insufficient points.")
-        db.close()
-        return
-    if reward.quantity_available <= 0:
-        query.answer()
-        safe_edit_message_media(
-            query,
-            COMPANY_IMAGE_URL,  # Use a fallback image URL here
-            "❌ This reward is no longer available.",
-            reply_markup=main_menu()
-        )
-        logger.info(f"{user.name} (ID: {user.telegram_id}) - Failed redemption: Reward out of stock ({reward.name}).")
-        db.close()
+        logger.info("%s (ID: %s) - Failed redemption: Invalid reward ID (%s).", user.name, user.telegram_id, reward_id)
         return
 
-    # Log redeem attempt
-    logger.info(f"{user.name} (ID: {user.telegram_id}) is redeeming {reward.name}")
-
-    # Handle TNG Rewards
-    if 'TNG' in reward.name.upper():
-        # Attempt to retrieve an available TNG pin
-        try:
-            tng_pin = get_tng_pin(db, reward, user)
-
-            # Deduct points and update reward quantity
-            user.points -= reward.points_required
-            reward.quantity_available -= 1
+    # Copy what the replies and logs need: a rollback expires every ORM instance in the session,
+    # and reading them afterwards would cost a refresh SELECT per failed redemption
+    user_name, user_telegram_id, reward_name = user.name, user.telegram_id, reward.name
 
-            # Log the transaction
-            transaction = Transaction(
-                user_id=user.id,
-                points_change=-reward.points_required,
-                description=f"Redeemed reward: {reward.name} (PIN: {tng_pin})",
-            )
-            db.add(transaction)
-            db.commit()
+    # Log redeem attempt
+    logger.info("%s (ID: %s) is redeeming %s", user_name, user_telegram_id, reward_name)
 
-            # Notify the user
-            query.answer()
+    rewards_table = Reward.__table__
+    users_table = User.__table__
+    try:
+        # Each UPDATE only matches while its invariant still holds, so concurrent
+        # redemptions can't oversell stock or overspend points
+        stock = db.execute(
+            update(rewards_table)
+            .where(rewards_table.c.id == reward.id, rewards_table.c.quantity_available > 0)
+            .values(quantity_available=rewards_table.c.quantity_available - 1)
+            .returning(rewards_table.c.quantity_available)
+        ).first()
+        if stock is None:
+            db.rollback()
             safe_edit_message_media(
                 query,
-                REDEEM_REWARDS_IMAGE_URL,  # Use a valid image URL for success
-                f"🎉 *Congratulations*, {user.name}! You've successfully redeemed *{reward.name}*.\n"
-                f"🔑 *Your TNG PIN:* {tng_pin}\n"
-                f"💰 *Your remaining points:* {user.points}",
+                COMPANY_IMAGE_URL,  # Use a fallback image URL here
+                "❌ This reward is no longer available.",
                 reply_markup=main_menu()
             )
-            logger.info(f"{user.name} (ID: {user.telegram_id}) redeemed PIN: {tng_pin}")
-        except ValueError as e:
-            # Handle case where no TNG PINs are available
-            query.answer()
+            logger.info("%s (ID: %s) - Failed redemption: Reward out of stock (%s).", user_name, user_telegram_id, reward_name)
+            return
+
+        balance = db.execute(
+            update(users_table)
+            .where(users_table.c.id == user.id, users_table.c.points >= reward.points_required)
+            .values(points=users_table.c.points - reward.points_required)
+            .returning(users_table.c.points)
+        ).first()
+        if balance is None:
+            db.rollback()
             safe_edit_message_media(
                 query,
-                REDEEM_REWARDS_IMAGE_URL,  # Use a fallback image
-                f"❗️ *Sorry*, no TNG PINs are currently available for *{reward.name}*. Please contact support.",
+                COMPANY_IMAGE_URL,  # Use a fallback image URL here
+                "❌ You don't have enough points to redeem this reward.",
                 reply_markup=main_menu()
             )
-            logger.warning(f"No TNG PINs available for {user.name} (ID: {user.telegram_id}) for reward {reward.name}")
-    else:
-        # Handle non-TNG rewards if applicable
-        # Example:
-        user.points -= reward.points_required
-        reward.quantity_available -= 1
-        db.commit()
+            logger.info("%s (ID: %s) - Failed redemption: Insufficient points.", user_name, user_telegram_id)
+            return
+
+        # TNG rewards also claim a PIN in the same transaction
+        tng_pin = get_tng_pin(db, reward, user) if 'TNG' in reward_name.upper() else None
 
-        # Log the transaction
-        transaction = Transaction(
+        # Log the transaction in the same commit as the deduction
+        description = f"Redeemed reward: {reward_name}"
+        if tng_pin:
+            description += f" (PIN: {tng_pin})"
+        db.execute(insert(Transaction.__table__).values(
             user_id=user.id,
             points_change=-reward.points_required,
-            description=f"Redeemed reward: {reward.name}",
-        )
-        db.add(transaction)
+            description=description,
+            kind=TRANSACTION_KIND_REDEMPTION,
+        ))
         db.commit()
-
-        # Send congratulations
-        query.answer()
+    except ValueError:
+        # Handle case where no TNG PINs are available
+        db.rollback()
         safe_edit_message_media(
             query,
-            REDEEM_REWARDS_IMAGE_URL,  # Use a valid image URL for reward redemption success
-            f"🎉 *Congratulations*, {user.name}! You've successfully redeemed *{reward.name}*.\n"
-            f"💰 *Your remaining points:* {user.points}",
+            REDEEM_REWARDS_IMAGE_URL,  # Use a fallback image
+            f"❗️ *Sorry*, no TNG PINs are currently available for *{reward_name}*. Please contact support.",
             reply_markup=main_menu()
         )
+        logger.warning("No TNG PINs available for %s (ID: %s) for reward %s", user_name, user_telegram_id, reward_name)
+        return
+    except Exception:
+        db.rollback()
+        raise
+
+    # Notify the user
+    if tng_pin:
+        caption = (
+            f"🎉 *Congratulations*, {user_name}! You've successfully redeemed *{reward_name}*.\n"
+            f"🔑 *Your TNG PIN:* {tng_pin}\n"
+            f"💰 *Your remaining points:* {balance.points}"
+        )
+        logger.info("%s (ID: %s) redeemed PIN: %s", user_name, user_telegram_id, tng_pin)
+    else:
+        caption = (
+            f"🎉 *Congratulations*, {user_name}! You've successfully redeemed *{reward_name}*.\n"
+            f"💰 *Your remaining points:* {balance.points}"
+        )
+        logger.info("%s (ID: %s) redeemed %s", user_name, user_telegram_id, reward_name)
+    safe_edit_message_media(
+        query,
+        REDEEM_REWARDS_IMAGE_URL,  # Use a valid image URL for reward redemption success
+        caption,
+        reply_markup=main_menu()
+    )
 
-        # Log successful redemption
-        logger.info(f"{user.name} (ID: {user.telegram_id}) redeemed {reward.name}")
-    db.close()
+def build_events_menu(db):
+    """Build the events keyboard, or None when there are no events."""
+    events = db.query(Event.id, Event.name).order_by(Event.date).all()
+    if not events:
+        return None
+    keyboard = []
+    for event in events:
+        keyboard.append([InlineKeyboardButton(event.name, callback_data=f"event_{event.id}")])
+    keyboard.append([InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")])
+    return InlineKeyboardMarkup(keyboard)
 
-def view_events(update: Update, context: CallbackContext):
+@with_session
+def view_events(update: Update, context: CallbackContext, db):
     """Display the events menu with buttons and delete the event poster if it exists."""
     query = update.callback_query
-    query.answer()
-    db = SessionLocal()
-
-    events = db.query(Event).order_by(Event.date).all()
-    if events:
-        keyboard = []
-        for event in events:
-            keyboard.append([InlineKeyboardButton(event.name, callback_data=f"event_{event.id}")])
-        keyboard.append([InlineKeyboardButton("🔙 Back to Main Menu", callback_data="main_menu")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    answer_callback_query(query, context)
 
+    reply_markup = cached_menu("events", lambda: build_events_menu(db))
+    if reply_markup:
         # Use safe_edit_message_media
         safe_edit_message_media(
             query,
@@ -643,34 +896,21 @@ def view_events(update: Update, context: CallbackContext):
             reply_markup=reply_markup
         )
     else:
-        query.answer()
         safe_edit_message_media(
             query,
             VIEW_EVENTS_IMAGE_URL,  
             "🛑 No events available at the moment.\n\nWhat would you like to do next?",
             reply_markup=main_menu(),
         )
-    db.close()
 
-def event_details(update: Update, context: CallbackContext):
+@with_session
+def event_details(update: Update, context: CallbackContext, db):
     """Display selected event's details with poster and appropriate image."""
     query = update.callback_query
-    query.answer()
-    db = SessionLocal()
+    answer_callback_query(query, context)
 
-    # Extract event ID from callback data
-    try:
-        event_id = int(query.data.split('_')[1])
-    except (IndexError, ValueError) as e:
-        logger.error(f"Error extracting event ID: {e}")
-        safe_edit_message_media(
-            query,
-            VIEW_EVENTS_IMAGE_URL,  # Use appropriate image URL
-            "❌ Invalid event selection. Please try again.",
-            reply_markup=main_menu()
-        )
-        db.close()
-        return
+    # The handler pattern only matches event_<digits>, so the ID is always present
+    event_id = int(context.match.group("id"))
 
     # Query the event from the database
     event = db.query(Event).filter_by(id=event_id).first()
@@ -698,7 +938,7 @@ def event_details(update: Update, context: CallbackContext):
                     reply_markup=reply_markup
                 )
             except Exception as e:
-                logger.error(f"Error sending photo for event {event.name}: {e}")
+                logger.error("Error sending photo for event %s: %s", event.name, e)
                 # Fallback to text-only message if the photo fails
                 safe_edit_message_media(
                     query,
@@ -722,45 +962,40 @@ def event_details(update: Update, context: CallbackContext):
             "❌ Event not found. Please select a valid event.",
             reply_markup=main_menu()
         )
-    db.close()
 
-def view_disposal_history_callback(update: Update, context: CallbackContext):
+@with_session
+def view_disposal_history_callback(update: Update, context: CallbackContext, db):
     """Display the user's disposal history with appropriate image."""
     query = update.callback_query
+    answer_callback_query(query, context)
     user_id = query.from_user.id
-    db = SessionLocal()
 
-    # Define your local timezone
-    local_tz = timezone("Asia/Kuala_Lumpur")
-
-    user = db.query(User).filter_by(telegram_id=user_id).first()
+    user = db.query(User.id).filter_by(telegram_id=user_id).first()
 
     if user:
         # Fetch the user's transactions related to disposal
         transactions = (
-            db.query(Transaction)
-            .filter(Transaction.user_id == user.id, Transaction.description.ilike("%Disposed%"))
+            db.query(Transaction.description, Transaction.created_at)
+            .filter(Transaction.user_id == user.id, Transaction.kind == TRANSACTION_KIND_DISPOSAL)
             .order_by(Transaction.created_at.desc())
             .limit(10)
             .all()
         )
 
         if transactions:
-            message = "🗑️ *Your Disposal History:*\n\n"
+            lines = ["🗑️ *Your Disposal History:*", ""]
             for transaction in transactions:
-                # Convert UTC to local timezone
-                utc_time = transaction.created_at.replace(tzinfo=utc)
-                local_time = utc_time.astimezone(local_tz)
-
-                # Format the local time properly for display
-                message += (
+                # Shift the stored UTC time to local time for display
+                local_time = transaction.created_at + LOCAL_UTC_OFFSET
+                lines.append(
                     f"- {transaction.description.replace('Disposed ', '')} at "
-                    f"{local_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+                    f"{local_time.strftime(HISTORY_TIME_FORMAT)}"
                 )
+            lines.append("")
+            message = "\n".join(lines)
         else:
             message = "📄 *No disposal activity found.*\n\nDispose some rubbish to earn points!"
 
-        query.answer()
         safe_edit_message_media(
             query,
             VIEW_DISPOSAL_HISTORY_IMAGE_URL,  # Correct image URL
@@ -768,60 +1003,52 @@ def view_disposal_history_callback(update: Update, context: CallbackContext):
             reply_markup=main_menu(),
         )
     else:
-        query.answer()
         safe_edit_message_media(
             query,
             VIEW_DISPOSAL_HISTORY_IMAGE_URL,  # Use appropriate image
             "❌ You are not registered. Please use /start to register.",
             reply_markup=main_menu()
         )
-    db.close()
 
-def leaderboard_callback(update: Update, context: CallbackContext):
+@with_session
+def leaderboard_callback(update: Update, context: CallbackContext, db):
     """Display the leaderboard of users and delete the event poster if it exists."""
     query = update.callback_query
+    answer_callback_query(query, context)
     user_id = query.from_user.id
-    db = SessionLocal()
 
-    # Fetch top users by points
-    top_users = db.query(User).order_by(User.points.desc()).limit(10).all()
+    # Fetch top users by points; RANK() gives tied users the same position and
+    # streams off the points index, so the LIMIT still stops after ten rows
+    top_users = (
+        db.query(User.name, User.points, func.rank().over(order_by=User.points.desc()).label("rank"))
+        .order_by(User.points.desc())
+        .limit(10)
+        .all()
+    )
 
     if top_users:
-        message = "🏆 *Leaderboard:*\n\n"
-        for idx, user in enumerate(top_users, start=1):
-            message += f"{idx}. {user.name} - {user.points} points\n"
-        query.answer()
-
-        # Delete the current event poster if it exists
-        delete_current_event_poster(context, query.message.chat_id)
-
-        # Update the message media with the Leaderboard image
-        safe_edit_message_media(
-            query,
-            LEADERBOARD_IMAGE_URL,            # Correct image URL
-            f"{message}\n\nWhat would you like to do next?",  # Correct caption
-            reply_markup=main_menu(),
-        )
+        lines = ["🏆 *Leaderboard:*", ""]
+        lines.extend(f"{user.rank}. {user.name} - {user.points} points" for user in top_users)
+        lines.append("")
+        message = "\n".join(lines)
     else:
-        query.answer()
+        message = "🛑 No users found on the leaderboard."
 
-        # Delete the current event poster if it exists
-        delete_current_event_poster(context, query.message.chat_id)
+    # Delete the current event poster if it exists
+    delete_current_event_poster(context, query.message.chat_id)
 
-        # Update the message media with the Leaderboard image
-        safe_edit_message_media(
-            query,
-            LEADERBOARD_IMAGE_URL,            # Use appropriate image
-            "🛑 No users found on the leaderboard.\n\nWhat would you like to do next?",
-            reply_markup=main_menu(),
-        )
-    db.close()
+    # Update the message media with the Leaderboard image
+    safe_edit_message_media(
+        query,
+        LEADERBOARD_IMAGE_URL,
+        f"{message}\n\nWhat would you like to do next?",
+        reply_markup=main_menu(),
+    )
 
 def main_menu_callback(update: Update, context: CallbackContext):
     """Return to the main menu and update the image."""
     query = update.callback_query
-    query.answer()
-    db = SessionLocal()
+    answer_callback_query(query, context)
 
     # Delete the current event poster if it exists
     delete_current_event_poster(context, query.message.chat_id)
@@ -833,14 +1060,50 @@ def main_menu_callback(update: Update, context: CallbackContext):
         "What would you like to do?",   # Correct caption
         reply_markup=main_menu()
     )
-    db.close()
+
+# Callback handlers keyed by the action (or id prefix) captured by CB_ROUTE
+CALLBACK_ROUTES = {
+    "check_balance": check_balance_callback,
+    "redeem_rewards": redeem_rewards_callback,
+    "redeem": process_reward_selection,
+    "view_events": view_events,
+    "event": event_details,
+    "leaderboard": leaderboard_callback,
+    "main_menu": main_menu_callback,
+    "view_disposal_history": view_disposal_history_callback,
+}
+
+def dispatch_callback(update: Update, context: CallbackContext):
+    """Route a button press with one regex match and a dict lookup."""
+    match = context.match
+    return CALLBACK_ROUTES[match.group("action") or match.group("prefix")](update, context)
+
+@functools.lru_cache(maxsize=64)
+def render_qr_png(payload: str) -> bytes:
+    """Render a QR code for payload as PNG bytes (cached, the payload is static per bin)."""
+    import qrcode  # Only needed by the admin /bin_qr command; keeps it (and PIL) off the startup path
+
+    buffer = io.BytesIO()
+    qrcode.make(payload).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def bin_qr(update: Update, context: CallbackContext):
+    """Send the admin the QR code that activates the bin for whoever scans it."""
+    if str(update.effective_user.id) != str(ADMIN_TELEGRAM_ID):
+        update.message.reply_text("🚫 This command is only available to the administrator.")
+        return
+
+    activation_url = f"https://t.me/{BOT_USERNAME}?start=activate_bin"
+    update.message.reply_photo(
+        photo=io.BytesIO(render_qr_png(activation_url)),
+        caption=f"📷 Scan to activate the bin: {activation_url}"
+    )
 
 def error_handler(update: object, context: CallbackContext):
     """Handle all errors."""
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
     
     # Notify the administrator
-    ADMIN_TELEGRAM_ID = os.getenv("ADMIN_TELEGRAM_ID")
     if ADMIN_TELEGRAM_ID:
         try:
             context.bot.send_message(
@@ -860,46 +1123,83 @@ def error_handler(update: object, context: CallbackContext):
 
 # MQTT Client Class
 
+def build_mqtt_ssl_context():
+    """Build the TLS context for the MQTT connection (system CAs unless a CA file is given)."""
+    context = ssl.create_default_context(cafile=MQTT_TLS_CA_CERT)
+    if MQTT_TLS_CERTFILE:
+        context.load_cert_chain(certfile=MQTT_TLS_CERTFILE, keyfile=MQTT_TLS_KEYFILE)
+    return context
+
+# Parsed once at startup and shared by every connection attempt
+MQTT_SSL_CONTEXT = build_mqtt_ssl_context() if MQTT_USE_TLS else None
+
 class MQTTClientHandler:
-    def __init__(self, broker_url, broker_port, username, password, topic, message_queue):
+    def __init__(self, broker_url, broker_port, username, password, topics, message_queue):
         self.broker_url = broker_url
         self.broker_port = broker_port
         self.username = username
         self.password = password
-        self.topic = topic
+        self.topics = topics
         self.message_queue = message_queue
         self.client = None
+
+        # Raw (payload, received_ns) pairs handed over by paho's network thread; bounded so a
+        # stalled flusher (e.g. during a database outage) sheds the oldest messages instead of memory
+        self._inbox = deque(maxlen=MQTT_INBOX_SIZE)
+        self._inbox_event = threading.Event()
+        self._dropped = 0
+        self._last_drop_warning = 0.0
+
+        # Disposals waiting to be written as one batch: (user_id, points, rubbish_type, received_ns)
+        self._pending = deque()
+        self._flush_failures = 0  # Consecutive failed writes; drives the retry backoff
+        self._retry_at = 0.0  # Monotonic time before which a failed batch is not retried
+
+        # (active user id, monotonic fetch time); the generation guards against caching a stale read
+        self._active_user_cache = None
+        self._active_user_generation = 0
+        self._active_user_lock = threading.Lock()
+
+        if MQTT_FLUSH_INTERVAL > 0:
+            threading.Thread(target=self._flush_loop, daemon=True).start()
+
         self.setup_client()  # Call the setup_client method
 
     def setup_client(self):
         unique_client_id = f"bot_{uuid.uuid4().hex[:8]}"
         logger.info(f"Setting up MQTT client with client ID: {unique_client_id}")
-        self.client = mqtt.Client(client_id=unique_client_id)
+        self.client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=unique_client_id,
+            transport="tcp",
+            protocol=mqtt.MQTTv5,
+        )
         # Configure authentication
         if self.username and self.password:
             logger.info("Using MQTT authentication.")
             self.client.username_pw_set(self.username, self.password)
 
         # Enable TLS if required
-        use_tls = os.getenv("MQTT_USE_TLS", "True").lower() == "true"
-        if use_tls:
-            tls_ca_cert = os.getenv("MQTT_TLS_CA_CERT")
-            tls_certfile = os.getenv("MQTT_TLS_CERTFILE")
-            tls_keyfile = os.getenv("MQTT_TLS_KEYFILE")
-
-            if tls_ca_cert:
-                self.client.tls_set(ca_certs=tls_ca_cert, certfile=tls_certfile, keyfile=tls_keyfile)
+        if MQTT_USE_TLS:
+            self.client.tls_set_context(MQTT_SSL_CONTEXT)
+            if MQTT_TLS_CA_CERT:
                 logger.info("🔒 TLS has been configured with provided certificates for MQTT client.")
             else:
-                self.client.tls_set()  # Default TLS settings
                 logger.info("🔒 TLS has been enabled with default settings for MQTT client.")
 
             # Optionally, disable certificate verification (not recommended for production)
-            tls_insecure = os.getenv("MQTT_TLS_INSECURE", "False").lower() == "true"
-            self.client.tls_insecure_set(tls_insecure)
+            self.client.tls_insecure_set(MQTT_TLS_INSECURE)
+
+        # Enable logging for MQTT on paho's own logger, which is capped at WARNING below
+        self.client.enable_logger()
 
-        # Enable logging for MQTT
-        self.client.enable_logger(logger)
+        # Back off between reconnect attempts instead of retrying in a tight loop
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+        # Outbound flow control: a wide in-flight window (QoS 0 traffic never waits on it),
+        # but keep the offline backlog bounded
+        self.client.max_inflight_messages_set(1000)
+        self.client.max_queued_messages_set(1000)
 
         # Attach callbacks
         self.client.on_connect = self.on_connect
@@ -907,133 +1207,274 @@ class MQTTClientHandler:
 
         try:
             logger.info(f"Connecting to MQTT broker at {self.broker_url}:{self.broker_port}...")
-            self.client.connect(self.broker_url, self.broker_port, keepalive=60)
-            logger.info("🔗 Connected to MQTT Broker!")
+            # Disposal events are fire-and-forget: bins should publish with qos=0, and a
+            # longer keepalive cuts idle PINGREQ traffic. The TCP/TLS handshake runs on
+            # paho's network thread; on_connect reports the outcome.
+            self.client.connect_async(self.broker_url, self.broker_port, keepalive=120)
         except Exception as e:
             logger.error(f"❌ Failed to connect to MQTT Broker: {e}")
             return
 
-        # Start the MQTT client loop in a separate thread
-        threading.Thread(target=self.client.loop_forever, daemon=True).start()
+        # Start paho's own network thread
+        self.client.loop_start()
         logger.info("🔄 MQTT client loop started.")
 
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if not reason_code.is_failure:
             logger.info("✅ MQTT Client connected successfully.")
-            result, mid = self.client.subscribe(self.topic)
+            # All topics go out in a single SUBSCRIBE packet
+            result, mid = self.client.subscribe([(topic, 0) for topic in self.topics])
             if result == mqtt.MQTT_ERR_SUCCESS:
-                logger.info(f"📡 Successfully subscribed to topic: {self.topic}")
+                logger.info(f"📡 Successfully subscribed to topics: {', '.join(self.topics)}")
             else:
-                logger.error(f"❌ Failed to subscribe to topic: {self.topic}. Error code: {result}")
+                logger.error(f"❌ Failed to subscribe to topics: {', '.join(self.topics)}. Error code: {result}")
         else:
-            logger.error(f"❌ MQTT Client failed to connect. Return code: {rc}")
+            logger.error(f"❌ MQTT Client failed to connect. Reason: {reason_code}")
 
     def on_message(self, client, userdata, msg):
-        """Handle incoming MQTT messages."""
+        """Hand incoming MQTT messages to the flusher so paho's network thread keeps reading."""
+        if MQTT_FLUSH_INTERVAL <= 0:
+            # Batching disabled: handle the message on the network thread
+            self.handle_payload(msg.payload, time.time_ns())
+            return
+
+        if len(self._inbox) == self._inbox.maxlen:
+            self._record_drop()
+        # Stamp with a plain integer; the flusher builds the datetime when it writes the row
+        self._inbox.append((msg.payload, time.time_ns()))
+        if len(self._inbox) >= MQTT_BATCH_SIZE:
+            self._inbox_event.set()
+
+    def _record_drop(self):
+        """Count a message shed because the backlog is full, warning at most once a minute."""
+        self._dropped += 1
+        now = time.monotonic()
+        if now - self._last_drop_warning >= 60:
+            logger.warning(f"⚠️ MQTT backlog full; dropped {self._dropped} oldest messages so far.")
+            self._last_drop_warning = now
+
+    def handle_payload(self, payload, received_ns):
+        """Parse one MQTT payload and queue its disposal."""
         try:
-            payload = msg.payload.decode()
-            logger.info(f"📥 Received MQTT message on topic {msg.topic}: {payload}")
+            logger.debug("📥 Received MQTT message: %s", payload)
 
-            # Parse the JSON payload
-            data = json.loads(payload)
-            rubbish_type = data.get('rubbish_type')
+            if len(payload) == 1:
+                # Compact binary payload: a single byte holding the rubbish type code
+                rubbish_type = RUBBISH_BY_CODE.get(payload[0])
+            else:
+                # Legacy JSON payload (orjson reads the raw bytes, no decode step);
+                # normalized here once so the lookups downstream use it as-is
+                rubbish_type = orjson.loads(payload).get('rubbish_type')
+                rubbish_type = rubbish_type.strip().lower() if isinstance(rubbish_type, str) else None
 
             if not rubbish_type:
                 logger.warning("⚠️ 'rubbish_type' not found in MQTT message.")
                 return
 
             # Assign points based on the rubbish type
-            self.assign_points(rubbish_type)
+            self.assign_points(rubbish_type, received_ns)
 
-        except json.JSONDecodeError:
-            logger.error("❌ Failed to decode MQTT message payload as JSON.")
+        except orjson.JSONDecodeError:
+            logger.error("❌ Failed to decode MQTT message payload as JSON: %r", payload)
         except Exception as e:
             logger.error(f"❌ Error in on_message: {e}")
 
-    def assign_points(self, rubbish_type):
-        """Assign points to the currently active user for the bin."""
+    def invalidate_active_user(self):
+        """Drop the cached active user so the next disposal reloads it."""
+        with self._active_user_lock:
+            self._active_user_cache = None
+            self._active_user_generation += 1
+
+    def get_active_user_id(self):
+        """Return the bin's active user id, hitting the DB at most once per ACTIVE_USER_CACHE_TTL."""
+        with self._active_user_lock:
+            cached = self._active_user_cache
+            if cached and time.monotonic() - cached[1] < ACTIVE_USER_CACHE_TTL:
+                return cached[0]
+            generation = self._active_user_generation
+
+        # Own short-lived session: handler threads call this while holding their scoped session,
+        # and a cache miss happens at most once per ACTIVE_USER_CACHE_TTL
         db = SessionLocal()
         try:
-            # Check for an active user
-            config = db.query(Configuration).first()
-            if not config or not config.active_user_id:
-                logger.warning("⚠️ No active user to assign points.")
+            row = (
+                db.query(Configuration.active_user_id)
+                .join(User, User.id == Configuration.active_user_id)
+                .first()
+            )
+        finally:
+            db.close()
+        user_id = row.active_user_id if row else None
+
+        with self._active_user_lock:
+            if generation == self._active_user_generation:
+                self._active_user_cache = (user_id, time.monotonic())
+        return user_id
+
+    def assign_points(self, rubbish_type, received_ns):
+        """Assign points to the currently active user for the bin."""
+        try:
+            # Get the points for the rubbish type; unknown types never reach the database
+            points = RUBBISH_POINTS.get(rubbish_type, 0)
+            if points == 0:
+                logger.warning("⚠️ Unknown rubbish type received: %s", rubbish_type)
                 return
 
-            active_user = db.query(User).filter_by(id=config.active_user_id).first()
-            if not active_user:
-                logger.warning("⚠️ Active user does not exist.")
+            # Check for an active user
+            active_user_id = self.get_active_user_id()
+            if not active_user_id:
+                logger.warning("⚠️ No active user to assign points.")
                 return
 
-            # Define points per rubbish type
-            rubbish_points = {
-                "plastic": 10,
-                "metal": 25,
-                "paper": 5,
-                "glass": 15,
-            }
+            if MQTT_FLUSH_INTERVAL <= 0 and len(self._pending) >= MQTT_INBOX_SIZE:
+                # Batching disabled and writes are failing: the pending queue is the backlog, so bound it
+                self._pending.popleft()
+                self._record_drop()
 
-            # Get the points for the rubbish type
-            points = rubbish_points.get(rubbish_type.lower(), 0)
-            if points == 0:
-                logger.warning(f"⚠️ Unknown rubbish type received: {rubbish_type}")
-                return
+            # Queue the disposal; it is written with the rest of its batch
+            self._pending.append((active_user_id, points, rubbish_type, received_ns))
+        except Exception as e:
+            logger.error(f"❌ Error assigning points: {e}")
+            return
 
-            # Generate a timestamp for the disposal (current UTC time)
-            disposal_time = datetime.utcnow()
+        if MQTT_FLUSH_INTERVAL <= 0:
+            # Batching disabled: write the disposal synchronously
+            self.flush_pending()
 
-            # Convert disposal_time to local timezone (Malaysia)
-            malaysia_tz = timezone("Asia/Kuala_Lumpur")
-            local_disposal_time = disposal_time.replace(tzinfo=utc).astimezone(malaysia_tz)
+    def _flush_loop(self):
+        """Parse and write received messages every MQTT_FLUSH_INTERVAL seconds, or sooner when a batch fills up."""
+        while True:
+            self._inbox_event.wait(MQTT_FLUSH_INTERVAL)
+            self._inbox_event.clear()
+            try:
+                while self._inbox:
+                    self.handle_payload(*self._inbox.popleft())
+                    if len(self._pending) >= MQTT_BATCH_SIZE and not self.flush_pending():
+                        break
+                else:
+                    self.flush_pending()
+            except Exception as e:
+                logger.error(f"❌ Error flushing disposals: {e}")
+
+            if self._flush_failures:
+                # Back off while the database is failing; new messages wait in the bounded inbox meanwhile
+                time.sleep(max(0.0, self._retry_at - time.monotonic()))
+
+    def flush_pending(self):
+        """Apply all pending disposals in one transaction and enqueue their notifications.
+
+        Returns False when the write failed (or is still backing off) and the batch stays queued.
+        """
+        if self._flush_failures and time.monotonic() < self._retry_at:
+            return False
+
+        # Only one thread touches _pending: the flusher, or paho's thread when batching is off
+        pending = list(self._pending)
+        self._pending.clear()
+        if not pending:
+            return True
+
+        # Total points per user, applied with one aggregated UPDATE:
+        # points = points + CASE id WHEN ... THEN ... END
+        deltas = defaultdict(int)
+        for user_id, points, _, _ in pending:
+            deltas[user_id] += points
+
+        users_table = User.__table__
+        add_points = (
+            update(users_table)
+            .where(users_table.c.id.in_(list(deltas)))
+            .values(points=users_table.c.points + case(dict(deltas), value=users_table.c.id, else_=0))
+            .returning(users_table.c.id, users_table.c.name, users_table.c.telegram_id, users_table.c.points)
+        )
 
-            # Update user points
-            active_user.points += points
+        # Receive times were captured as epoch nanoseconds; convert them once, here
+        batch = [
+            (user_id, points, rubbish_type, datetime.fromtimestamp(received_ns / 1e9, timezone.utc).replace(tzinfo=None))
+            for user_id, points, rubbish_type, received_ns in pending
+        ]
 
-            # Log the transaction in the database
-            transaction = Transaction(
-                user_id=active_user.id,
-                points_change=points,
-                description=f"Disposed {rubbish_type} from the bin",
-                created_at=disposal_time
-            )
-            db.add(transaction)
+        db = Session()
+        try:
+            # The new balances come back with the UPDATE, no follow-up SELECT needed
+            users = {user.id: user for user in db.execute(add_points)}
+
+            # Log the transactions in the database with a single multi-row INSERT; users deleted
+            # since they were cached as active got no points and must not get a row either
+            rows = [
+                {
+                    "user_id": user_id,
+                    "points_change": points,
+                    "description": f"Disposed {rubbish_type} from the bin",
+                    "kind": TRANSACTION_KIND_DISPOSAL,
+                    "created_at": disposal_time,
+                }
+                for user_id, points, rubbish_type, disposal_time in batch
+                if user_id in users
+            ]
+            if rows:
+                db.execute(insert(Transaction.__table__), rows)
             db.commit()
+        except Exception as e:
+            db.rollback()
+            # Put the batch back ahead of anything queued since; it is retried until the database
+            # recovers, with a backoff doubling from 0.5 s up to 30 s
+            self._flush_failures += 1
+            self._retry_at = time.monotonic() + min(0.5 * 2 ** (self._flush_failures - 1), 30)
+            self._pending.extendleft(reversed(pending))
+            logger.error(f"❌ Error assigning points for {len(pending)} disposals, will retry: {e}")
+            return False
+
+        self._flush_failures = 0
+        if len(rows) < len(batch):
+            logger.warning("⚠️ Skipped %d disposals for users that no longer exist.", len(batch) - len(rows))
+            self.invalidate_active_user()
+
+        # Replay the batch against each user's balance so every notification shows its running total
+        balances = {user_id: users[user_id].points - delta for user_id, delta in deltas.items() if user_id in users}
+        for user_id, points, rubbish_type, disposal_time in batch:
+            if user_id not in users:
+                continue
+            user = users[user_id]
+            balances[user_id] += points
 
             # Log both UTC and local time for clarity
             logger.info(
-                f"✅ Assigned {points} points to {active_user.name} for disposing {rubbish_type} "
-                f"at {disposal_time} (UTC) / {local_disposal_time} (local time)."
+                "✅ Assigned %s points to %s for disposing %s at %s (UTC) / %s (local time).",
+                points, user.name, rubbish_type, disposal_time, disposal_time + LOCAL_UTC_OFFSET,
             )
 
-            # Enqueue the notification
-            self.message_queue.put({
-                'chat_id': active_user.telegram_id,
-                'text': (
-                    f"🎉 *Great Job*, {active_user.name}!\n\n"
-                    f"You've earned *{points} points* for disposing *{rubbish_type}*.\n\n"
-                    f"💰 *Your current balance:* {active_user.points} points."
-                )
-            })
-        except Exception as e:
-            db.rollback()
-            logger.error(f"❌ Error assigning points: {e}")
-        finally:
-            db.close()
+            # Enqueue the raw values; the sender thread formats the text
+            self.message_queue.put((user.telegram_id, user.name, points, rubbish_type, balances[user_id]))
+        return True
+
+def send_queued_notification(chat_id, text):
+    """Send one (possibly coalesced) notification, staying under Telegram's rate limit."""
+    try:
+        notification_rate_limiter.acquire()
+        send_notification_message(updater.bot, chat_id=chat_id, text=text)
+        logger.info("📨 Sent notification to chat ID %s.", chat_id)
+    except Exception as e:
+        logger.error(f"❌ Error sending queued message: {e}")
 
 def process_message_queue():
-    """Process and send messages from the queue."""
-    while True:
-        try:
-            message = message_queue.get()
-            if message:
-                send_notification_message(
-                    updater.bot,
-                    chat_id=message["chat_id"],
-                    text=message["text"],
-                )
-                logger.info(f"📨 Sent notification to chat ID {message['chat_id']}.")
-        except Exception as e:
-            logger.error(f"❌ Error sending queued message: {e}")
+    """Collect queued notifications briefly, merge them per chat and fan the sends out to a pool."""
+    # The executor's own work queue is unbounded; cap the sends handed to it so that while Telegram
+    # is slow the backlog stays in message_queue, where its maxlen drops the oldest notifications
+    in_flight = threading.BoundedSemaphore(NOTIFICATION_WORKERS * 2)
+    with ThreadPoolExecutor(max_workers=NOTIFICATION_WORKERS, thread_name_prefix="notify") as executor:
+        while True:
+            batch = message_queue.get_batch(NOTIFICATION_BATCH_SIZE, NOTIFICATION_BATCH_WINDOW)
+
+            # One message per chat, even if the user disposed of several items in the window
+            texts_by_chat = defaultdict(list)
+            for chat_id, name, points, rubbish_type, balance in batch:
+                texts_by_chat[chat_id].append(DISPOSAL_NOTIFICATION_TEMPLATE % (name, points, rubbish_type, balance))
+
+            for chat_id, texts in texts_by_chat.items():
+                in_flight.acquire()
+                future = executor.submit(send_queued_notification, chat_id, NOTIFICATION_SEPARATOR.join(texts))
+                future.add_done_callback(lambda _: in_flight.release())
 
 def initialize_bot():
     """Initialize the Telegram bot and related services."""
@@ -1048,7 +1489,7 @@ def initialize_bot():
         return
 
     # Ensure only one Configuration row exists
-    db = SessionLocal()
+    db = Session()
     try:
         config_count = db.query(Configuration).count()
         if config_count == 0:
@@ -1066,46 +1507,37 @@ def initialize_bot():
     except Exception as e:
         logger.error(f"❌ Failed to ensure single Configuration row: {e}")
     finally:
-        db.close()
+        Session.remove()
 
     # Validate essential environment variables
     if not all([TOKEN, BOT_USERNAME, WEBHOOK_URL]):
         logger.error("❌ TELEGRAM_BOT_TOKEN, BOT_USERNAME, and WEBHOOK_URL must be set in environment variables.")
         return
 
-    # Register handlers
+    # Register handlers; they run on the update worker threads started below
     dispatcher.add_handler(CommandHandler("start", start))
     dispatcher.add_handler(CommandHandler("active_user", active_user))
+    dispatcher.add_handler(CommandHandler("bin_qr", bin_qr))
     dispatcher.add_handler(MessageHandler(Filters.contact, register_contact))
     dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, collect_name))
-    dispatcher.add_handler(CallbackQueryHandler(check_balance_callback, pattern="^check_balance$"))
-    dispatcher.add_handler(CallbackQueryHandler(redeem_rewards_callback, pattern="^redeem_rewards$"))
-    dispatcher.add_handler(CallbackQueryHandler(process_reward_selection, pattern="^redeem_"))
-    dispatcher.add_handler(CallbackQueryHandler(view_events, pattern="^view_events$"))
-    dispatcher.add_handler(CallbackQueryHandler(leaderboard_callback, pattern="^leaderboard$"))
-    dispatcher.add_handler(CallbackQueryHandler(main_menu_callback, pattern="^main_menu$"))
-    dispatcher.add_handler(CallbackQueryHandler(event_details, pattern="^event_"))
-    dispatcher.add_handler(CallbackQueryHandler(view_disposal_history_callback, pattern="^view_disposal_history$"))
+    dispatcher.add_handler(CallbackQueryHandler(dispatch_callback, pattern=CB_ROUTE))
 
     # Register the error handler
     dispatcher.add_error_handler(error_handler)
 
-    # Set the webhook (Flask route will handle incoming updates)
-    try:
-        updater.bot.set_webhook(url=f"{WEBHOOK_URL}/{TOKEN}")
-        logger.info(f"✅ Webhook set to {WEBHOOK_URL}/{TOKEN}")
-    except Exception as e:
-        logger.error(f"❌ Failed to set webhook: {e}")
-        return
+    # Drain the webhook's bounded update queue on a fixed set of worker threads
+    for i in range(BOT_WORKERS):
+        threading.Thread(target=process_updates, name=f"updates-{i}", daemon=True).start()
 
-    # Initialize the MQTT client
+    # Initialize the MQTT client first so the broker handshake overlaps the webhook setup
+    global mqtt_client
     try:
         mqtt_client = MQTTClientHandler(
             broker_url=MQTT_BROKER_URL,
             broker_port=MQTT_BROKER_PORT,
             username=MQTT_USERNAME,
             password=MQTT_PASSWORD,
-            topic=MQTT_TOPIC,
+            topics=MQTT_TOPICS,
             message_queue=message_queue,
         )
         logger.info("✅ MQTT client initialized successfully.")
@@ -1116,6 +1548,22 @@ def initialize_bot():
     # Start the message queue processing in a separate thread
     threading.Thread(target=process_message_queue, daemon=True).start()
 
+    # Set the webhook (Flask route will handle incoming updates)
+    try:
+        updater.bot.set_webhook(
+            url=f"{WEBHOOK_URL}/{TOKEN}",
+            allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+            max_connections=40,
+        )
+        logger.info(f"✅ Webhook set to {WEBHOOK_URL}/{TOKEN}")
+    except Exception as e:
+        logger.error(f"❌ Failed to set webhook: {e}")
+        return
+
+    # Warm the file_id cache for the static menu images, uploading only those not stored yet
+    load_image_file_ids()
+    preload_images(updater.bot)
+
     logger.info("✅ Bot is running with webhook and Flask managed by Render.")
 
 # Remove the background thread and call initialize_bot() directly
@@ -0,0 +1,10 @@
+# create_indexes.py
+from database import engine
+from models import Base
+
+# Create any model indexes missing from an existing database
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
+        print(f"Ensured index {index.name} on {table.name}")
+print("Indexes created successfully!")
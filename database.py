@@ -1,20 +1,22 @@
 # database.py
 import os
+import hashlib
 import logging
 from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Define the base class for declarative models
-Base = declarative_base()
-
 # Database Connection
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Local marker recording the schema that init_db() last verified
+SCHEMA_VERSION_FILE = os.getenv("SCHEMA_VERSION_FILE", ".schema_version")
+
 if not DATABASE_URL:
     logger.error("DATABASE_URL environment variable is not set.")
     raise ValueError("DATABASE_URL environment variable is not set.")
@@ -30,21 +32,64 @@ connect_args = {}
 if DATABASE_URL.startswith("postgresql"):
     connect_args["sslmode"] = "require"
 
+# Keep a warm connection pool for the bot's handler threads (SQLite manages its own pool)
+engine_kwargs = {}
+if not DATABASE_URL.startswith("sqlite"):
+    # pool_recycle retires connections before managed Postgres/proxies drop them as idle
+    engine_kwargs.update(pool_size=20, max_overflow=40, pool_pre_ping=True, pool_recycle=1800)
+
+# psycopg2: pack executemany INSERTs into multi-row VALUES and batch executemany UPDATEs
+# (a psycopg2-only option; other drivers reject it)
+if make_url(DATABASE_URL).get_driver_name() == "psycopg2":
+    engine_kwargs["executemany_mode"] = "values_plus_batch"
+
+# Compiled SQL is cached per statement shape; room for every handler and admin query
 engine = create_engine(
     DATABASE_URL,
-    connect_args=connect_args
+    connect_args=connect_args,
+    query_cache_size=1200,
+    **engine_kwargs
 )
 
 # Create a configured "Session" class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Thread-local session registry; call Session.remove() once the unit of work is done.
+# Long-running threads (MQTT network thread, disposal flusher) keep their session for
+# the life of the thread, so loaded attributes are not expired on every commit.
+Session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine, expire_on_commit=False))
+
 # Import models explicitly at the module level
-from models import User, Reward, Transaction, Redemption, Event, UserSession, Configuration,TNGPin  # Ensure all models are imported
+from models import Base, User, Reward, Transaction, Redemption, Event, UserSession, Configuration,TNGPin, CachedImage  # Ensure all models are imported
+
+def schema_version():
+    """
+    Hash of the DDL the models compile to, plus the target database.
+    """
+    digest = hashlib.sha256(DATABASE_URL.encode())
+    for table in Base.metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=engine.dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            digest.update(str(CreateIndex(index).compile(dialect=engine.dialect)).encode())
+    return digest.hexdigest()
 
-def init_db():
+def init_db(force=False):
     """
     Initialize the database by creating all tables.
+
+    Skipped when SCHEMA_VERSION_FILE shows this schema was already created
+    against this database; pass force=True to check anyway.
     """
+    version = schema_version()
+    if not force:
+        try:
+            with open(SCHEMA_VERSION_FILE) as f:
+                if f.read().strip() == version:
+                    logger.info("Schema unchanged since last start; skipping table check.")
+                    return
+        except OSError:
+            pass
+
     try:
         logger.info("Initializing database...")
         Base.metadata.create_all(bind=engine)
@@ -52,3 +97,9 @@ def init_db():
     except Exception as e:
         logger.error(f"❌ Error creating tables: {e}")
         raise e
+
+    try:
+        with open(SCHEMA_VERSION_FILE, "w") as f:
+            f.write(version)
+    except OSError as e:
+        logger.warning(f"Unable to write {SCHEMA_VERSION_FILE}: {e}")
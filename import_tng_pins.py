@@ -0,0 +1,52 @@
+# import_tng_pins.py
+from database import SessionLocal
+from models import Reward, TNGPin
+
+# Legacy pin files and the reward each one belongs to
+PIN_FILES = {
+    "tng_pins_rm5.txt": "TNG Pin RM5",
+    "tng_pins_rm10.txt": "TNG Pin RM10",
+}
+USED_PREFIX = "#USED#"
+
+def import_pins(db_session, pin_file, reward_name, known_pins):
+    """Load the pins from a legacy text file into the tng_pins table.
+
+    known_pins holds every pin already stored or imported (pins are unique across all
+    rewards) and is updated in place, so duplicates across files are skipped too.
+    """
+    reward = db_session.query(Reward).filter_by(name=reward_name).first()
+    if not reward:
+        print(f"Reward not found: {reward_name}")
+        return 0
+
+    added = 0
+    with open(pin_file, "r") as f:
+        for line in f:
+            pin = line.strip()
+            if not pin:
+                continue
+            used = pin.startswith(USED_PREFIX)
+            if used:
+                pin = pin[len(USED_PREFIX):]
+            if pin in known_pins:
+                continue
+            db_session.add(TNGPin(pin=pin, reward_id=reward.id, used=used))
+            known_pins.add(pin)
+            added += 1
+    return added
+
+if __name__ == "__main__":
+    db_session = SessionLocal()
+    try:
+        known_pins = {pin for (pin,) in db_session.query(TNGPin.pin)}
+        for pin_file, reward_name in PIN_FILES.items():
+            added = import_pins(db_session, pin_file, reward_name, known_pins)
+            print(f"Imported {added} pins from {pin_file} for {reward_name}")
+        db_session.commit()
+        print("TNG pins imported successfully!")
+    except Exception as e:
+        db_session.rollback()
+        print(f"An error occurred: {e}")
+    finally:
+        db_session.close()
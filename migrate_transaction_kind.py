@@ -0,0 +1,40 @@
+# migrate_transaction_kind.py
+from sqlalchemy import inspect, text
+from database import engine
+from models import (
+    Transaction, TRANSACTION_KIND_DISPOSAL, TRANSACTION_KIND_REDEMPTION, TRANSACTION_KIND_ADJUSTMENT
+)
+
+def migrate():
+    """Add the transactions.kind column, backfill it and create the history index."""
+    columns = {column["name"] for column in inspect(engine).get_columns("transactions")}
+
+    with engine.begin() as conn:
+        if "kind" not in columns:
+            conn.execute(text("ALTER TABLE transactions ADD COLUMN kind VARCHAR"))
+            print("Added column transactions.kind")
+
+        # Classify existing rows from the descriptions the bot writes
+        backfill = [
+            (TRANSACTION_KIND_DISPOSAL, "Disposed %"),
+            (TRANSACTION_KIND_REDEMPTION, "Redeemed reward:%"),
+        ]
+        for kind, pattern in backfill:
+            result = conn.execute(
+                text("UPDATE transactions SET kind = :kind WHERE kind IS NULL AND description LIKE :pattern"),
+                {"kind": kind, "pattern": pattern},
+            )
+            print(f"Backfilled {result.rowcount} '{kind}' transactions")
+        result = conn.execute(
+            text("UPDATE transactions SET kind = :kind WHERE kind IS NULL"),
+            {"kind": TRANSACTION_KIND_ADJUSTMENT},
+        )
+        print(f"Backfilled {result.rowcount} '{TRANSACTION_KIND_ADJUSTMENT}' transactions")
+
+    for index in Transaction.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+        print(f"Ensured index {index.name}")
+
+if __name__ == "__main__":
+    migrate()
+    print("Transaction kind migration completed successfully!")
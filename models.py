@@ -1,26 +1,36 @@
 # models.py
 
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Date, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Date, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
-import re
 import logging
 
 Base = declarative_base()
 
+# Transaction kinds
+TRANSACTION_KIND_DISPOSAL = "disposal"
+TRANSACTION_KIND_REDEMPTION = "redemption"
+TRANSACTION_KIND_ADJUSTMENT = "adjustment"
+
 # Sensitive Info Filter
 class SensitiveInfoFilter(logging.Filter):
     """Filter to redact sensitive information like the bot token in logs."""
-    def __init__(self, sensitive_data: list):
+    def __init__(self, sensitive_data):
         super().__init__()
-        self.sensitive_data = sensitive_data
+        # Unset values (None/empty) would match everywhere, so keep only real secrets
+        self.sensitive_data = tuple(sensitive for sensitive in sensitive_data if sensitive)
 
     def filter(self, record):
-        if record.msg:
-            # Replace each sensitive string with a placeholder
-            for sensitive in self.sensitive_data:
-                record.msg = re.sub(rf"{sensitive}", "[REDACTED]", str(record.msg))
+        if record.msg and self.sensitive_data:
+            # Check the merged message so secrets passed as lazy %-style args are caught too
+            message = record.getMessage()
+            if any(sensitive in message for sensitive in self.sensitive_data):
+                # Replace each sensitive string with a placeholder
+                for sensitive in self.sensitive_data:
+                    message = message.replace(sensitive, "[REDACTED]")
+                record.msg = message
+                record.args = None
         return True
 
 class TNGPin(Base):
@@ -40,6 +50,11 @@ class TNGPin(Base):
     def __repr__(self):
         return f"<TNGPin(pin='{self.pin}', reward_id={self.reward_id}, used={self.used})>"
 
+    __table_args__ = (
+        # Finds the next unused pin for a reward without scanning the whole pin table
+        Index('ix_tngpin_reward_used', 'reward_id', 'used'),
+    )
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
@@ -57,6 +72,11 @@ class User(Base):
     def __repr__(self):
         return f"<User(name='{self.name}', telegram_id={self.telegram_id}, points={self.points})>"
 
+    __table_args__ = (
+        # Leaderboard: top users by points, with name included so Postgres can answer from the index
+        Index('ix_users_points_desc', points.desc(), postgresql_include=['name']),
+    )
+
 class Reward(Base):
     __tablename__ = "rewards"
     id = Column(Integer, primary_key=True, index=True)
@@ -78,6 +98,7 @@ class Transaction(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     points_change = Column(Integer, nullable=False)
     description = Column(String, nullable=False)
+    kind = Column(String, nullable=True)  # One of the TRANSACTION_KIND_* values
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
     # Relationships
@@ -86,6 +107,11 @@ class Transaction(Base):
     def __repr__(self):
         return f"<Transaction(user_id={self.user_id}, points_change={self.points_change}, description='{self.description}')>"
 
+    __table_args__ = (
+        # Serves the per-user history lookups (newest first) as an index range scan
+        Index('ix_transactions_user_kind_created', 'user_id', 'kind', created_at.desc()),
+    )
+
 class Redemption(Base):
     __tablename__ = "redemptions"
     id = Column(Integer, primary_key=True, index=True)
@@ -139,3 +165,11 @@ class Configuration(Base):
     __table_args__ = (
         UniqueConstraint('id', name='uix_configuration_id'),
     )
+
+class CachedImage(Base):
+    __tablename__ = "cached_images"
+    url = Column(String, primary_key=True)
+    file_id = Column(String, nullable=False)  # Telegram file_id of the uploaded image (valid for this bot only)
+
+    def __repr__(self):
+        return f"<CachedImage(url='{self.url}', file_id='{self.file_id}')>"